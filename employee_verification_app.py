@@ -14,18 +14,18 @@ Flow
 # ────────────────────────────────────────────────
 # Imports & basic config
 # ────────────────────────────────────────────────
-import hashlib, random, string, time, datetime
+import atexit, concurrent.futures, csv, hashlib, hmac, secrets, threading, time, datetime
 from pathlib import Path
 import pandas as pd, streamlit as st
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import smtplib, gspread
-from google.oauth2.service_account import Credentials
+# smtplib / email.mime / gspread / google.oauth2 are imported lazily inside
+# their helpers: they pull in ssl and crypto stacks that slow cold start but
+# are only needed once the user clicks "Send code" or submits.
 
-ALLOWED_EMAIL_DOMAINS = {"gmail.com", "yahoo.com", "outlook.com"}
+ALLOWED_EMAIL_DOMAINS = frozenset({"gmail.com", "yahoo.com", "outlook.com"})
 OTP_VALID_SEC, RESEND_COOLDOWN_SEC, MAX_TRIES = 300, 30, 3
 EXCEL = "Employee Master IT 2.0.xlsx"
 SHEET_NAME, LOCAL_CSV = "Verified Corrections Log", "verified_corrections_log.csv"
+LOCAL_IDS = "verified_ids.txt"  # narrow sidecar index of the CSV log, one ID per line
 
 NAME_COLS = {
     "employee_first_name", "employee_middle_name", "employee_last_name", "employee_father_name"
@@ -38,54 +38,212 @@ EMAIL_PASSWORD = st.secrets["EMAIL_PASSWORD"]
 # ────────────────────────────────────────────────
 # Helpers
 # ────────────────────────────────────────────────
+def _load_raw():
+    """Load EXCEL via a Parquet sidecar, regenerated when the xlsx is newer."""
+    xlsx, pq = Path(EXCEL), Path(EXCEL).with_suffix(".parquet")
+    if pq.exists() and pq.stat().st_mtime >= xlsx.stat().st_mtime:
+        return pd.read_parquet(pq, engine="pyarrow")
+    df = pd.read_excel(xlsx, engine="calamine")
+    try:
+        df.to_parquet(pq, compression="zstd")
+    except Exception:
+        # Mixed-type object columns (date_of_substantive_entry holds strings,
+        # datetimes and floats) cannot round-trip through Arrow; serve the
+        # freshly parsed frame and drop any partial sidecar.
+        pq.unlink(missing_ok=True)
+    return df
+
 @st.cache_data
 def load_master():
-    df = pd.read_excel(EXCEL)
-    return df.set_index("employee_id")
+    df = _load_raw()
+    df["employee_id"] = pd.to_numeric(df["employee_id"], errors="coerce").astype("Int64")
+    df = df.set_index("employee_id")
+    # Dictionary-encode the low-cardinality dropdown columns and keep names as
+    # Arrow strings: far smaller than boxed PyObject strings, faster unique/loc.
+    for c in df.columns:
+        if c in NAME_COLS:
+            df[c] = df[c].astype("string[pyarrow]")
+        elif c not in FORCE_DATE and not pd.api.types.is_datetime64_any_dtype(df[c]) and pd.api.types.is_string_dtype(df[c]):
+            df[c] = df[c].astype("category")
+    return df
 
 df_master = load_master()
+EMP_IDS = frozenset(int(i) for i in df_master.index.dropna())
+
+@st.cache_data
+def build_drop_options(df):
+    cols = [
+        c for c in df.columns
+        if c not in NAME_COLS and c not in FORCE_DATE
+        and not pd.api.types.is_datetime64_any_dtype(df[c])
+    ]
+    opts = {}
+    for c in cols:
+        # Category columns already hold their unique values; no scan needed.
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            vals = df[c].cat.categories
+        else:
+            vals = df[c].dropna().unique()
+        opts[c] = tuple(sorted({s for s in (str(v).strip() for v in vals) if s}))
+    return opts
 
-DROP_OPTIONS = {}
-for c in df_master.columns:
-    if c in NAME_COLS or c in FORCE_DATE: continue
-    if pd.api.types.is_datetime64_any_dtype(df_master[c]): continue
-    vals = df_master[c].fillna("").astype(str).str.strip().unique().tolist()
-    DROP_OPTIONS[c] = sorted(v for v in vals if v)
+DROP_OPTIONS = build_drop_options(df_master)
 
-mk_otp = lambda n=6: "".join(random.choices(string.digits,k=n))
-sha = lambda s: hashlib.sha256(s.encode()).hexdigest()
+def _fmt_date(v):
+    # FORCE_DATE columns mix real datetimes with raw strings/numbers in the
+    # source workbook; only format values that actually carry a date.
+    if pd.isna(v): return ''
+    return v.strftime('%d/%m/%Y') if isinstance(v,(pd.Timestamp,datetime.date)) else str(v)
+def _fmt_plain(v): return '' if pd.isna(v) else str(v)
+
+WIDGET_KIND = {
+    c: ("text" if c in NAME_COLS
+        else "date" if c in FORCE_DATE or pd.api.types.is_datetime64_any_dtype(df_master[c])
+        else "select")
+    for c in df_master.columns
+}
+
+FMT = {"date": _fmt_date, "text": _fmt_plain, "select": _fmt_plain}
+
+LABELS = {c: c.replace('_',' ').title() for c in df_master.columns}
+
+mk_otp = lambda n=6: f"{secrets.randbelow(10**n):0{n}d}"
+sha = lambda s: hashlib.sha256(s.encode()).digest()
+
+@st.cache_resource
+def _smtp_state():
+    """Process-wide SMTP connection slot + lock, closed once at interpreter exit."""
+    state = {"srv": None, "lock": threading.Lock()}
+    def _quit():
+        if state["srv"] is not None:
+            try: state["srv"].quit()
+            except Exception: pass
+    atexit.register(_quit)
+    return state
+
+def _smtp(state):
+    """Return a live SMTP connection (TLS+auth once); caller must hold state["lock"]."""
+    import smtplib
+    srv = state["srv"]
+    if srv is not None:
+        try:
+            srv.noop(); return srv
+        except (smtplib.SMTPException, OSError):
+            state["srv"] = None
+    srv = smtplib.SMTP("smtp.gmail.com",587)
+    srv.starttls(); srv.login(EMAIL_ADDRESS,EMAIL_PASSWORD)
+    state["srv"] = srv
+    return srv
 
 def send_code(email, code):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
     msg = MIMEMultipart(); msg["From"], msg["To"] = EMAIL_ADDRESS, email
     msg["Subject"] = "Your one‑time code"
     msg.attach(MIMEText(f"Your code is {code}. It works for 5 minutes.","plain"))
-    with smtplib.SMTP("smtp.gmail.com",587) as s:
-        s.starttls(); s.login(EMAIL_ADDRESS,EMAIL_PASSWORD); s.sendmail(EMAIL_ADDRESS,email,msg.as_string())
+    state = _smtp_state()
+    with state["lock"]:
+        _smtp(state).sendmail(EMAIL_ADDRESS,email,msg.as_string())
+
+# OTP mail goes out on a worker thread so the SMTP handshake never blocks the rerun.
+@st.cache_resource
+def _mail_pool():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
+@st.cache_resource
 def gs():
+    import gspread
+    from google.oauth2.service_account import Credentials
     creds = Credentials.from_service_account_info(st.secrets["gspread_service_account"])
     return gspread.authorize(creds).open(SHEET_NAME).sheet1
 
-def already_done(emp):
+@st.cache_data(ttl=120)
+def _done_ids():
     try:
-        return str(emp) in gs().col_values(1)
+        return frozenset(gs().col_values(1))
     except Exception:
-        p=Path(LOCAL_CSV); return p.exists() and str(emp) in pd.read_csv(p,usecols=["employee_id"],dtype=str)["employee_id"].tolist()
+        return frozenset(_csv_done_ids())
+
+@st.cache_resource
+def _csv_done_ids():
+    """IDs already in the local CSV fallback log, loaded once per process."""
+    ids=set()
+    p=Path(LOCAL_IDS)
+    if p.exists():
+        with open(p) as f:
+            ids={line.strip() for line in f if line.strip()}
+    elif Path(LOCAL_CSV).exists():
+        # Older logs predate the sidecar: derive the index from the wide CSV once.
+        with open(LOCAL_CSV,newline="") as f:
+            reader=csv.reader(f); next(reader,None)
+            ids={r[0] for r in reader if r}
+        with open(p,"w") as f:
+            f.write("".join(f"{i}\n" for i in ids))
+    return ids
+
+def already_done(emp):
+    seen = st.session_state.setdefault("_checked_done", {})
+    if emp in seen: return seen[emp]
+    result = str(emp) in _done_ids()
+    seen[emp] = result
+    return result
+
+FLUSH_ROWS, FLUSH_SEC = 10, 5
+
+@st.cache_resource
+def _log_buffer():
+    """Process-wide pending-row buffer for batched Sheets appends; drained at exit."""
+    buf = {"rows": [], "lock": threading.Lock(), "last_flush": time.time(), "header": None}
+    atexit.register(_flush_pending, buf)
+    return buf
+
+def _csv_fallback(batch, header):
+    """Append raw value rows to the local CSV log and its ID sidecar."""
+    with open(LOCAL_CSV,"a",newline="") as f:
+        w=csv.writer(f)
+        if f.tell()==0 and header: w.writerow(header)
+        w.writerows(batch)
+    with open(LOCAL_IDS,"a") as f:
+        f.writelines(f"{r[0]}\n" for r in batch)
+    _csv_done_ids().update(r[0] for r in batch)
 
 def save_log(row):
-    try: gs().append_row([str(row[k]) for k in row])
+    """Queue the row and flush to Sheets in batches to stay under API quota."""
+    buf = _log_buffer()
+    with buf["lock"]:
+        buf["header"] = list(row.keys())
+        buf["rows"].append([str(v) for v in row.values()])
+        if len(buf["rows"]) < FLUSH_ROWS and time.time()-buf["last_flush"] < FLUSH_SEC:
+            return
+        batch, buf["rows"][:] = list(buf["rows"]), []
+    try:
+        gs().append_rows(batch, value_input_option="RAW")
+        buf["last_flush"] = time.time()
     except Exception:
-        p=Path(LOCAL_CSV); pd.DataFrame([row]).to_csv(p,mode="a",header=not p.exists(),index=False)
+        _csv_fallback(batch, buf["header"])
+    _done_ids.clear()
+    st.session_state.pop("_checked_done", None)
+
+def _flush_pending(buf):
+    """Best-effort drain of queued log rows when the worker shuts down."""
+    with buf["lock"]:
+        batch, buf["rows"][:] = list(buf["rows"]), []
+        header = buf["header"]
+    if not batch: return
+    try:
+        gs().append_rows(batch, value_input_option="RAW")
+    except Exception:
+        _csv_fallback(batch, header)
 
 # ────────────────────────────────────────────────
 # Session state defaults
 # ────────────────────────────────────────────────
 for k,v in {
-    "otp_hash":"","otp_time":0.0,"otp_sent":False,"tries":0,"auth":False,
+    "otp_hash":b"","otp_time":0.0,"otp_sent":False,"tries":0,"auth":False,
     "email":"","emp_id":"","field_idx":0,"answers":{},"done":False
 }.items(): st.session_state.setdefault(k,v)
 
-FIELDS = list(df_master.columns)
+FIELDS = tuple(df_master.columns)
 
 # ════════════════════════════════════════════════
 # 1. Login step
@@ -96,16 +254,17 @@ if not st.session_state.auth:
         email = st.text_input("Email (Gmail / Yahoo / Outlook)",value=st.session_state.email)
         emp = st.text_input("Employee ID",value=st.session_state.emp_id)
         if st.form_submit_button("Send code"):
-            if not any(email.lower().endswith("@"+d) for d in ALLOWED_EMAIL_DOMAINS):
+            parts = email.rsplit("@",1)
+            if len(parts)!=2 or parts[1].lower() not in ALLOWED_EMAIL_DOMAINS:
                 st.error("Use Gmail, Yahoo or Outlook address.")
-            elif not emp.isdigit() or int(emp) not in df_master.index:
+            elif not emp.isdigit() or int(emp) not in EMP_IDS:
                 st.error("Employee ID not found.")
             elif already_done(int(emp)):
                 st.error("You already verified. Contact HQ to reopen.")
             elif time.time()-st.session_state.otp_time<RESEND_COOLDOWN_SEC:
                 st.warning("Wait a few seconds and try again.")
             else:
-                code = mk_otp(); send_code(email,code)
+                code = mk_otp(); _mail_pool().submit(send_code,email,code)
                 st.session_state.update({"otp_hash":sha(code),"otp_time":time.time(),"otp_sent":True,"email":email.strip(),"emp_id":emp.strip(),"tries":0})
                 st.success("Code sent!")
     if st.session_state.otp_sent:
@@ -115,53 +274,64 @@ if not st.session_state.auth:
                 st.error("Code expired."); st.session_state.otp_sent=False
             elif st.session_state.tries>=MAX_TRIES:
                 st.error("Too many tries. Wait and retry.")
-            elif sha(code)==st.session_state.otp_hash:
+            elif hmac.compare_digest(sha(code),st.session_state.otp_hash):
                 st.session_state.auth=True
+                st.session_state.row=df_master.loc[int(st.session_state.emp_id)].to_dict()
+                st.session_state.disp={c:(FMT[WIDGET_KIND[c]](v) or '<blank>') for c,v in st.session_state.row.items()}
             else:
                 st.session_state.tries+=1; st.error("Code didn’t match.")
 
 # ════════════════════════════════════════════════
 # 2. One‑question‑at‑a‑time wizard
 # ════════════════════════════════════════════════
-if st.session_state.auth and not st.session_state.done:
-    eid=int(st.session_state.emp_id); row=df_master.loc[eid]
+@st.fragment
+def wizard():
+    eid=int(st.session_state.emp_id); row=st.session_state.row
     idx=st.session_state.field_idx
     if idx>=len(FIELDS):
         # all done
         data_row={"employee_id":eid,"email":st.session_state.email,"timestamp":datetime.datetime.now().isoformat()}
         for col,(orig,new) in st.session_state.answers.items():
-            data_row[f"{col}_original"]= '' if pd.isna(orig) else (orig.strftime('%d/%m/%Y') if isinstance(orig,pd.Timestamp) else orig)
+            fmt=FMT[WIDGET_KIND[col]]
+            data_row[f"{col}_original"]=fmt(orig)
             data_row[f"{col}_status"]='changed' if new is not None else 'ok'
-            data_row[f"{col}_new"]='' if new is None else (new.strftime('%d/%m/%Y') if isinstance(new,pd.Timestamp) else new)
+            data_row[f"{col}_new"]='' if new is None else fmt(new)
         save_log(data_row)
         st.session_state.done=True
-        st.success("Thank you! Your response is recorded."); st.balloons()
-        st.stop()
+        st.rerun()  # full rerun so the thank-you page renders outside the fragment
 
     col=FIELDS[idx]
     orig=row[col]
-    disp = orig.strftime('%d/%m/%Y') if isinstance(orig,pd.Timestamp) else ('<blank>' if pd.isna(orig) else str(orig))
-    st.header(f"{idx+1}/{len(FIELDS)} • {col.replace('_',' ').title()}")
-    st.write(f"Current value: **{disp}**")
-    choice=st.radio(f"Is *{col.replace('_',' ').title()}* correct?",["Yes","No"],horizontal=True,key=f"q{idx}")
-
-    if choice=="Yes":
-        st.session_state.answers[col]=(orig,None)
-        st.session_state.field_idx+=1
-        st.experimental_rerun()
-    else:
-        # show corrector widget
-        if col in NAME_COLS:
-            new_val=st.text_input("Type the correct text")
-        elif col in FORCE_DATE or pd.api.types.is_datetime64_any_dtype(df_master[col]):
-            base=orig.to_pydatetime() if isinstance(orig,pd.Timestamp) else datetime.date.today()
-            new_val=pd.to_datetime(st.date_input("Pick the right date",value=base))
+    disp = st.session_state.disp[col]
+    st.markdown(f"#### {idx+1}/{len(FIELDS)} • {LABELS[col]}\n\nCurrent value: **{disp}**")
+    # One st.form per field: widget state is batched browser-side and a single
+    # rerun fires on submit, instead of one rerun per radio click plus a manual one.
+    with st.form(f"q{idx}"):
+        choice=st.radio(f"Is *{LABELS[col]}* correct?",["Yes","No"],horizontal=True)
+        kind=WIDGET_KIND[col]
+        if kind=="text":
+            new_val=st.text_input("If not, type the correct text")
+        elif kind=="date":
+            base=orig.date() if isinstance(orig,pd.Timestamp) else (orig if isinstance(orig,datetime.date) else datetime.date.today())
+            new_val=st.date_input("If not, pick the right date",value=base)
         else:
-            opts=DROP_OPTIONS.get(col,[])
+            opts=DROP_OPTIONS.get(col,())
             if disp not in opts and disp!="<blank>":
-                opts=[disp]+opts
-            new_val=st.selectbox("Choose the right value",opts)
-        if st.button("Save and continue") and (new_val!=""   ):
+                opts=(disp,)+opts
+            new_val=st.selectbox("If not, choose the right value",opts)
+        submitted=st.form_submit_button("Save and continue")
+    if submitted:
+        if choice=="Yes":
+            st.session_state.answers[col]=(orig,None)
+            st.session_state.field_idx+=1
+            st.rerun(scope="fragment")
+        elif new_val!="":
             st.session_state.answers[col]=(orig,new_val)
             st.session_state.field_idx+=1
-            st.experimental_rerun()
+            st.rerun(scope="fragment")
+
+if st.session_state.auth and not st.session_state.done:
+    wizard()
+
+if st.session_state.auth and st.session_state.done:
+    st.success("Thank you! Your response is recorded."); st.balloons()